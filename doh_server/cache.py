@@ -0,0 +1,285 @@
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from dns import flags, message, rcode, rdatatype
+from dns.message import Message
+
+# File layout: one header followed by a fixed number of fixed-size slots.
+# Header: magic, version, slot count, value size.
+HEADER = struct.Struct("!4sHIH")
+HEADER_SIZE = 64
+MAGIC = b"DOHC"
+VERSION = 1
+# Slot: sequence counter (odd while a writer holds the slot), key hash,
+# expiry timestamp (wall clock, shared by every process), key and value lengths.
+SLOT_HEADER = struct.Struct("!IQdHH")
+SEQUENCE = struct.Struct("!I")
+SLOT_FIELDS = struct.Struct("!QdHH")
+# Lowercased wire qname (255 max) + rdtype + rdclass + DO, CD and EDNS flags.
+MAX_KEY_SIZE = 260
+MAX_PROBE = 8
+STRIPES = 64
+CACHEABLE_RCODES = (rcode.NOERROR, rcode.NXDOMAIN)
+# Type, class, TTL and rdata length of a resource record.
+RR_HEADER = struct.Struct("!HHIH")
+
+_caches = {}
+
+
+def make_key(query: Message) -> Optional[bytes]:
+    """Build the cache key of a DNS query.
+    :param query: DNS query.
+    :return: the key as bytes, or None if the query can not be cached.
+    """
+    if len(query.question) != 1:
+        return None
+    question = query.question[0]
+    # Responses differ with DNSSEC records (DO), unvalidated data (CD) and OPT.
+    options = (
+        (1 if query.ednsflags & flags.DO else 0)
+        | (2 if query.flags & flags.CD else 0)
+        | (4 if query.edns >= 0 else 0)
+    )
+    return question.name.canonicalize().to_wire() + struct.pack(
+        "!HHB", question.rdtype, question.rdclass, options
+    )
+
+
+def get_ttl(response: Message) -> int:
+    """Lowest TTL of the answer and authority sections, 0 if not cacheable.
+    :param response: DNS response.
+    :return: the number of seconds the response can be cached.
+    """
+    if response.rcode() not in CACHEABLE_RCODES or response.flags & flags.TC:
+        return 0
+    rrsets = response.answer + response.authority
+    if not rrsets:
+        return 0
+    ttl = min(r.ttl for r in rrsets)
+    if response.rcode() == rcode.NXDOMAIN or not response.answer:
+        # Negative TTL of RFC 2308 section 5.
+        for rrset in response.authority:
+            if rrset.rdtype == rdatatype.SOA:
+                ttl = min(ttl, rrset[0].minimum)
+    return ttl
+
+
+class SharedMemoryCache:
+    """DNS responses cache shared by every process of the host.
+
+    Entries are stored in wire format in a memory-mapped file, in a fixed-layout
+    hash table with open addressing (linear probing). Reads are lock-free and
+    rely on a per-slot sequence counter, writes are serialized by striped locks.
+    """
+
+    def __init__(self, path: str, slots: int = 65536, value_size: int = 1232):
+        self.path = path
+        self.slots = slots
+        self.value_size = value_size
+        self.slot_size = SLOT_HEADER.size + MAX_KEY_SIZE + value_size
+        self.size = size = HEADER_SIZE + self.slots * self.slot_size
+        # fcntl locks are held per process, threads are serialized apart.
+        self.write_lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        expected = HEADER.pack(MAGIC, VERSION, slots, value_size)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, expected, 0)
+            header = os.pread(self.fd, HEADER.size, 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+        if header != expected:
+            os.close(self.fd)
+            raise Exception("Cache file %s has been created with another layout" % path)
+        self.mm = mmap.mmap(self.fd, size)
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    def _offset(self, index: int) -> int:
+        return HEADER_SIZE + index * self.slot_size
+
+    def _lock(self, index: int, lock_type: int):
+        # Stripe locks are taken on bytes past the end of the file.
+        fcntl.lockf(self.fd, lock_type, 1, self.size + index % STRIPES)
+
+    @staticmethod
+    def _hash(key: bytes) -> int:
+        # Must be stable across processes, so the builtin hash() can not be used.
+        h = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+        return h or 1
+
+    def get(self, key: bytes) -> Optional[tuple]:
+        """Lock-free lookup.
+        :param key: key built by make_key.
+        :return: (wire, expiry timestamp) or None on a miss.
+        """
+        h = self._hash(key)
+        now = time.time()
+        for probe in range(MAX_PROBE):
+            offset = self._offset((h + probe) % self.slots)
+            seq, slot_hash, expires, key_len, value_len = SLOT_HEADER.unpack_from(
+                self.mm, offset
+            )
+            if slot_hash == 0:
+                return None
+            if slot_hash != h or seq & 1:
+                continue
+            start = offset + SLOT_HEADER.size
+            slot_key = self.mm[start:start + key_len]
+            start += MAX_KEY_SIZE
+            value = self.mm[start:start + value_len]
+            if SLOT_HEADER.unpack_from(self.mm, offset)[0] != seq:
+                # The slot has been rewritten while being read.
+                return None
+            if slot_key == key:
+                if expires <= now:
+                    return None
+                return value, expires
+        return None
+
+    def set(self, key: bytes, value: bytes, ttl: int) -> bool:
+        """Store a value, replacing the same key, an expired entry or the entry
+        closest to expiry among the probed slots.
+        :param key: key built by make_key.
+        :param value: DNS response in wire format.
+        :param ttl: number of seconds before the entry expires.
+        :return: True if the value has been stored.
+        """
+        if ttl <= 0 or len(key) > MAX_KEY_SIZE or len(value) > self.value_size:
+            return False
+        h = self._hash(key)
+        now = time.time()
+        index = h % self.slots
+        self.write_lock.acquire()
+        self._lock(index, fcntl.LOCK_EX)
+        try:
+            victim = None
+            victim_expires = None
+            for probe in range(MAX_PROBE):
+                candidate = (h + probe) % self.slots
+                offset = self._offset(candidate)
+                _, slot_hash, expires, key_len, _ = SLOT_HEADER.unpack_from(
+                    self.mm, offset
+                )
+                if slot_hash == h:
+                    start = offset + SLOT_HEADER.size
+                    if self.mm[start:start + key_len] == key:
+                        victim = candidate
+                        break
+                if slot_hash == 0 or expires <= now:
+                    victim = candidate
+                    break
+                if victim is None or expires < victim_expires:
+                    victim = candidate
+                    victim_expires = expires
+            self._write(victim, h, now + ttl, key, value)
+        finally:
+            self._lock(index, fcntl.LOCK_UN)
+            self.write_lock.release()
+        return True
+
+    def _write(self, index: int, h: int, expires: float, key: bytes, value: bytes):
+        # Probe sequences of different stripes overlap, so the slot itself is
+        # also locked while it is rewritten.
+        offset = self._offset(index)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.slot_size, offset)
+        try:
+            # A writer killed in the middle of a write leaves the counter odd.
+            seq = SEQUENCE.unpack_from(self.mm, offset)[0] | 1
+            SEQUENCE.pack_into(self.mm, offset, seq)
+            SLOT_FIELDS.pack_into(
+                self.mm, offset + SEQUENCE.size, h, expires, len(key), len(value)
+            )
+            start = offset + SLOT_HEADER.size
+            self.mm[start:start + len(key)] = key
+            start += MAX_KEY_SIZE
+            self.mm[start:start + len(value)] = value
+            # The even counter is stored last, on its own, so readers never see
+            # it with fields of another write.
+            SEQUENCE.pack_into(self.mm, offset, (seq + 1) & 0xFFFFFFFF)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+
+def _skip_name(wire: bytearray, offset: int) -> int:
+    while True:
+        length = wire[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += length + 1
+        if length == 0:
+            return offset
+
+
+def patch_ttl(wire: bytes, expires: float) -> tuple:
+    """Decrease the TTLs of a cached response by the time spent in cache, in
+    place in the wire format, and set its ID to 0.
+    :param wire: DNS response in wire format.
+    :param expires: expiry timestamp of the entry.
+    :return: (wire, lowest TTL of the answer section or None).
+    """
+    remaining = max(int(expires - time.time()), 0)
+    data = bytearray(wire)
+    data[0:2] = b"\x00\x00"
+    qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHH", data, 4)
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(data, offset) + 4
+    answer_ttl = None
+    for i in range(ancount + nscount + arcount):
+        offset = _skip_name(data, offset)
+        rdtype, _, ttl, rdlength = RR_HEADER.unpack_from(data, offset)
+        # The TTL of an OPT record holds the EDNS flags.
+        if rdtype != rdatatype.OPT:
+            ttl = min(ttl, remaining)
+            struct.pack_into("!I", data, offset + 4, ttl)
+            if i < ancount:
+                answer_ttl = ttl if answer_ttl is None else min(answer_ttl, ttl)
+        offset += RR_HEADER.size + rdlength
+    if offset > len(data):
+        raise ValueError("Truncated DNS message in cache")
+    return bytes(data), answer_ttl
+
+
+def from_cache(wire: bytes, expires: float) -> Message:
+    """Rebuild a cached response, with TTLs decreased by the time spent in cache.
+    :param wire: DNS response in wire format.
+    :param expires: expiry timestamp of the entry.
+    :return: the DNS response.
+    """
+    response = message.from_wire(wire)
+    ttl = max(int(expires - time.time()), 0)
+    for rrset in response.answer + response.authority + response.additional:
+        rrset.ttl = min(rrset.ttl, ttl)
+    return response
+
+
+def get_cache(conf: Optional[dict]) -> Optional[SharedMemoryCache]:
+    """Return the cache of this process for the given configuration.
+    :param conf: (optional) the "CACHE" entry of the DOH_SERVER setting.
+    :return: a cache instance or None if the cache is disabled.
+    """
+    if not conf:
+        return None
+    default_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    path = conf.get("PATH", os.path.join(default_dir, "doh-server-cache"))
+    slots = conf.get("SLOTS", 65536)
+    value_size = conf.get("VALUE_SIZE", 1232)
+    cache = _caches.get(path)
+    if cache is None or (cache.slots, cache.value_size) != (slots, value_size):
+        logging.getLogger("doh-server").debug("Cache used: " + path)
+        cache = SharedMemoryCache(path, slots=slots, value_size=value_size)
+        _caches[path] = cache
+    return cache
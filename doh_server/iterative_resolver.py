@@ -0,0 +1,317 @@
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import List, Optional
+
+from dns import exception, flags, name, query, rcode, rdataclass, rdatatype
+from dns.message import Message, make_query, make_response
+
+# IPv4 addresses of the root servers (https://www.iana.org/domains/root/servers).
+ROOT_HINTS = [
+    "198.41.0.4",
+    "170.247.170.2",
+    "192.33.4.12",
+    "199.7.91.13",
+    "192.203.230.10",
+    "192.5.5.241",
+    "192.112.36.4",
+    "198.97.190.53",
+    "192.36.148.17",
+    "192.58.128.30",
+    "193.0.14.129",
+    "199.7.83.42",
+    "202.12.27.33",
+]
+MAX_REFERRALS = 16
+MAX_CNAMES = 8
+MAX_DEPTH = 4
+MAX_SERVERS = 4
+MAX_ENTRIES = 100000
+# Minimum number of seconds between two purges of a full cache.
+PURGE_INTERVAL = 60
+
+
+class InfrastructureCache:
+    """Delegations (NS records), nameserver addresses (glue) and smoothed RTT of
+    each nameserver, shared by every query of the process."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.next_purge = 0.0
+        self.delegations = {}
+        self.addresses = {}
+        self.rtt = {}
+
+    def add_delegation(self, zone: name.Name, ns_names: List[name.Name], ttl: int):
+        now = time.time()
+        with self.lock:
+            if not self._full(self.delegations, zone, now):
+                self.delegations[zone] = (ns_names, now + ttl)
+
+    def add_addresses(self, ns_name: name.Name, addresses: List[str], ttl: int):
+        now = time.time()
+        with self.lock:
+            if not self._full(self.addresses, ns_name, now):
+                self.addresses[ns_name] = (addresses, now + ttl)
+
+    def _full(self, table: dict, key, now: float) -> bool:
+        """Check if a new key can not be stored, purging the cache at most once
+        every PURGE_INTERVAL seconds. The lock must be held.
+        """
+        if key in table or len(table) < self.max_entries:
+            return False
+        if now >= self.next_purge:
+            self.purge(now)
+            self.next_purge = now + PURGE_INTERVAL
+        return len(table) >= self.max_entries
+
+    def purge(self, now: float):
+        """Remove the expired entries, and the RTT of the addresses no longer
+        cached once there are too many of them. The lock must be held.
+        """
+        for table in (self.delegations, self.addresses):
+            for key in [k for k, v in table.items() if v[1] <= now]:
+                del table[key]
+        if len(self.rtt) >= self.max_entries:
+            cached = {a for addresses, _ in self.addresses.values() for a in addresses}
+            for address in [a for a in self.rtt if a not in cached]:
+                del self.rtt[address]
+
+    def get_delegation(self, qname: name.Name) -> tuple:
+        """Closest enclosing zone of a name with a valid delegation.
+        :param qname: the name to resolve.
+        :return: (zone, NS names), zone is None if nothing is cached.
+        """
+        now = time.time()
+        with self.lock:
+            while qname != name.root:
+                entry = self.delegations.get(qname)
+                if entry and entry[1] > now:
+                    return qname, entry[0]
+                qname = qname.parent()
+        return None, []
+
+    def get_addresses(self, ns_name: name.Name) -> List[str]:
+        with self.lock:
+            entry = self.addresses.get(ns_name)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        return []
+
+    def update_rtt(self, address: str, rtt: float):
+        with self.lock:
+            previous = self.rtt.get(address)
+            if previous is None:
+                if self._full(self.rtt, address, time.time()):
+                    return
+                self.rtt[address] = rtt
+            else:
+                self.rtt[address] = 0.7 * previous + 0.3 * rtt
+
+    def sort_by_rtt(self, addresses: List[str]) -> List[str]:
+        # Never tried nameservers come first, so each one gets a measurement.
+        with self.lock:
+            return sorted(addresses, key=lambda a: self.rtt.get(a, 0.0))
+
+
+infrastructure_cache = InfrastructureCache()
+
+
+class IterativeResolverClient:
+    """Resolve queries by walking the delegations from the root servers."""
+
+    def __init__(
+        self,
+        root_hints: Optional[List[str]] = None,
+        port: int = 53,
+        cache: Optional[InfrastructureCache] = None,
+    ):
+        self.name_server = "iterative"
+        self.root_hints = root_hints or ROOT_HINTS
+        self.port = port
+        self.cache = cache or infrastructure_cache
+        self.timeout = 0.4
+
+    def resolve(self, message: Message) -> Message:
+        logger = logging.getLogger("doh-server")
+        question = message.question[0]
+        qname = question.name
+        dnssec_ok = bool(message.ednsflags & flags.DO)
+        answers = []
+        for _ in range(MAX_CNAMES):
+            logger.debug("Iterative resolution of: " + str(qname))
+            response = self._resolve(
+                qname, question.rdtype, 0, question.rdclass, dnssec_ok
+            )
+            if response is None:
+                return 0
+            answers.extend(response.answer)
+            target = self._cname_target(response, qname, question.rdtype)
+            if target is None:
+                break
+            qname = target
+        else:
+            return 0
+        result = make_response(message)
+        result.flags |= flags.RA
+        if dnssec_ok:
+            result.want_dnssec(True)
+        result.set_rcode(response.rcode())
+        result.answer = answers
+        if not response.answer:
+            result.authority = response.authority
+        return result
+
+    @staticmethod
+    def _cname_target(response: Message, qname: name.Name, rdtype: int):
+        """Follow the CNAME chain of the answer.
+        :return: the name to resolve next, or None if the answer is complete.
+        """
+        if rdtype == rdatatype.CNAME:
+            return None
+        rrsets = {(r.name, r.rdtype): r for r in response.answer}
+        for _ in range(MAX_CNAMES):
+            if (qname, rdtype) in rrsets:
+                return None
+            cname = rrsets.get((qname, rdatatype.CNAME))
+            if cname is None:
+                break
+            qname = cname[0].target
+        if (qname, rdtype) in rrsets or qname == response.question[0].name:
+            return None
+        return qname
+
+    def _resolve(
+        self,
+        qname: name.Name,
+        rdtype: int,
+        depth: int,
+        rdclass: int = rdataclass.IN,
+        dnssec_ok: bool = False,
+    ) -> Optional[Message]:
+        # The DS records of a zone are served by the servers of its parent zone.
+        is_ds = rdtype == rdatatype.DS and qname != name.root
+        zone, ns_names = self.cache.get_delegation(qname.parent() if is_ds else qname)
+        addresses = self._addresses(ns_names, depth) if zone else []
+        if not addresses:
+            zone, addresses = name.root, self.root_hints
+        for _ in range(MAX_REFERRALS):
+            response = self._query(qname, rdtype, addresses, rdclass, dnssec_ok)
+            if response is None:
+                return None
+            child = self._referral(response, zone, qname)
+            if child is None or (is_ds and child[0] == qname):
+                return self._in_bailiwick(response, zone)
+            zone, ns_names = child
+            addresses = self._addresses(ns_names, depth)
+            if not addresses:
+                return None
+        return None
+
+    @staticmethod
+    def _in_bailiwick(response: Message, zone: name.Name) -> Optional[Message]:
+        """Keep only the records a server is authoritative for, the names out of
+        its zone (CNAME targets) are resolved from their own servers.
+        :return: the filtered response, or None if it is not authoritative.
+        """
+        if not response.flags & flags.AA:
+            return None
+        response.answer = [r for r in response.answer if r.name.is_subdomain(zone)]
+        response.authority = [
+            r for r in response.authority if r.name.is_subdomain(zone)
+        ]
+        response.additional = []
+        return response
+
+    def _referral(self, response: Message, zone: name.Name, qname: name.Name):
+        """Cache the delegation and glue of a referral.
+        :return: (child zone, NS names), or None if the response is not a referral.
+        """
+        if response.answer or response.rcode() != rcode.NOERROR:
+            return None
+        for rrset in response.authority:
+            if rrset.rdtype == rdatatype.SOA:
+                return None
+        for rrset in response.authority:
+            if (
+                rrset.rdtype == rdatatype.NS
+                and rrset.name != zone
+                and rrset.name.is_subdomain(zone)
+                and qname.is_subdomain(rrset.name)
+            ):
+                ns_names = [rdata.target for rdata in rrset]
+                self.cache.add_delegation(rrset.name, ns_names, rrset.ttl)
+                glue = {}
+                for additional in response.additional:
+                    # Only glue from the zone of the server can be trusted.
+                    if (
+                        additional.rdtype in (rdatatype.A, rdatatype.AAAA)
+                        and additional.name in ns_names
+                        and additional.name.is_subdomain(zone)
+                    ):
+                        addresses, ttl = glue.get(additional.name, ([], additional.ttl))
+                        addresses.extend(rdata.address for rdata in additional)
+                        glue[additional.name] = (addresses, min(ttl, additional.ttl))
+                for ns_name, (addresses, ttl) in glue.items():
+                    self.cache.add_addresses(ns_name, addresses, ttl)
+                return rrset.name, ns_names
+        return None
+
+    def _addresses(self, ns_names: List[name.Name], depth: int) -> List[str]:
+        addresses = []
+        missing = []
+        for ns_name in ns_names:
+            cached = self.cache.get_addresses(ns_name)
+            if cached:
+                addresses.extend(cached)
+            else:
+                missing.append(ns_name)
+        if addresses or depth >= MAX_DEPTH:
+            return addresses
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = [
+                executor.submit(self._resolve_address, ns_name, depth + 1)
+                for ns_name in missing
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                addresses.extend(future.result())
+        return addresses
+
+    def _resolve_address(self, ns_name: name.Name, depth: int) -> List[str]:
+        response = self._resolve(ns_name, rdatatype.A, depth)
+        if response is None:
+            return []
+        for rrset in response.answer:
+            if rrset.rdtype == rdatatype.A:
+                addresses = [rdata.address for rdata in rrset]
+                self.cache.add_addresses(ns_name, addresses, rrset.ttl)
+                return addresses
+        return []
+
+    def _query(
+        self,
+        qname: name.Name,
+        rdtype: int,
+        addresses: List[str],
+        rdclass: int = rdataclass.IN,
+        dnssec_ok: bool = False,
+    ):
+        request = make_query(qname, rdtype, rdclass, want_dnssec=dnssec_ok)
+        request.flags &= ~flags.RD
+        for address in self.cache.sort_by_rtt(addresses)[:MAX_SERVERS]:
+            start = time.monotonic()
+            try:
+                response = query.udp(request, address, timeout=self.timeout, port=self.port)
+                if response.flags & flags.TC:
+                    response = query.tcp(
+                        request, address, timeout=self.timeout, port=self.port
+                    )
+            except (exception.Timeout, OSError):
+                self.cache.update_rtt(address, self.timeout * 2)
+                continue
+            self.cache.update_rtt(address, time.monotonic() - start)
+            if response.rcode() in (rcode.NOERROR, rcode.NXDOMAIN):
+                return response
+        return None
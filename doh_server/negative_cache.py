@@ -0,0 +1,388 @@
+import base64
+import bisect
+import threading
+import time
+from typing import Optional
+
+from dns import dnssec, flags, name, rcode, rdatatype
+from dns.message import Message, from_wire, make_response
+
+DNSSEC_TYPES = (rdatatype.RRSIG, rdatatype.NSEC, rdatatype.NSEC3)
+MAX_ENTRIES = 100000
+# Minimum number of seconds between two purges of a full cache.
+PURGE_INTERVAL = 60
+# Higher NSEC3 iterations are too expensive to hash on each query (RFC 9276).
+MAX_NSEC3_ITERATIONS = 100
+B32_TO_B32HEX = bytes.maketrans(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZ234567", b"0123456789ABCDEFGHIJKLMNOPQRSTUV"
+)
+
+
+def with_dnssec(query: Message) -> Message:
+    """Copy of a query asking the upstream resolver for the DNSSEC records.
+    :param query: DNS query of the client.
+    :return: the query to send upstream.
+    """
+    upstream = from_wire(query.to_wire())
+    upstream.use_edns(
+        0,
+        query.ednsflags | flags.DO,
+        max(query.payload, 1232),
+        options=query.options,
+    )
+    upstream.flags |= flags.AD
+    return upstream
+
+
+def strip_dnssec(response: Message, query: Message) -> Message:
+    """Remove the DNSSEC records the client did not ask for.
+    :param response: DNS response to the query built by with_dnssec.
+    :param query: DNS query of the client.
+    :return: the response for the client.
+    """
+    if query.ednsflags & flags.DO:
+        return response
+    # The records of the type asked for are kept, even a DNSSEC type.
+    rdtype = query.question[0].rdtype
+    response.answer = [
+        r for r in response.answer if r.rdtype not in DNSSEC_TYPES or r.rdtype == rdtype
+    ]
+    response.authority = [
+        r for r in response.authority if r.rdtype not in DNSSEC_TYPES
+    ]
+    response.additional = [
+        r for r in response.additional if r.rdtype not in DNSSEC_TYPES
+    ]
+    if not query.flags & flags.AD:
+        response.flags &= ~flags.AD
+    if query.edns < 0:
+        response.use_edns(False)
+    return response
+
+
+def get_types(rdata) -> set:
+    """Types of the bitmap of a NSEC or NSEC3 record."""
+    types = set()
+    for window, bitmap in rdata.windows:
+        for i, byte in enumerate(bitmap):
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    types.add(window * 256 + i * 8 + bit)
+    return types
+
+
+def covers(owner, next_owner, value) -> bool:
+    """Check if a value is strictly between the owner and the next owner of a
+    NSEC or NSEC3 record, the last record of a zone wraps around to the first.
+    """
+    if owner < next_owner:
+        return owner < value < next_owner
+    return value > owner or value < next_owner
+
+
+class Entry:
+    def __init__(
+        self, next_owner, types: set, rrsets: list, expires: float, opt_out=False
+    ):
+        self.next_owner = next_owner
+        self.types = types
+        self.rrsets = rrsets
+        self.expires = expires
+        self.opt_out = opt_out
+
+
+class Zone:
+    """NSEC or NSEC3 records of a signed zone, sorted by owner."""
+
+    def __init__(self, soa: list, expires: float):
+        self.soa = soa
+        self.expires = expires
+        self.nsec3_params = None
+        self.owners = []
+        self.entries = {}
+
+    def add(self, owner, entry: Entry) -> bool:
+        """Store a record.
+        :return: True if the owner was not already known.
+        """
+        new = owner not in self.entries
+        if new:
+            bisect.insort(self.owners, owner)
+        self.entries[owner] = entry
+        return new
+
+    def find(self, value, now: float) -> tuple:
+        """Record matching or covering a value (a name for NSEC, a hash for NSEC3).
+        :return: (entry, True if the owner matches), or (None, False).
+        """
+        entry = self.entries.get(value)
+        if entry:
+            return (entry, True) if entry.expires > now else (None, False)
+        if not self.owners:
+            return None, False
+        # Index -1 is the last record of the zone, which wraps around.
+        owner = self.owners[bisect.bisect_left(self.owners, value) - 1]
+        entry = self.entries[owner]
+        if entry.expires > now and covers(owner, entry.next_owner, value):
+            return entry, False
+        return None, False
+
+    def purge(self, now: float):
+        for owner in [o for o, e in self.entries.items() if e.expires <= now]:
+            del self.entries[owner]
+        self.owners = [o for o in self.owners if o in self.entries]
+
+
+class NegativeCache:
+    """NSEC and NSEC3 ranges of validated negative responses, used to synthesize
+    NXDOMAIN and NODATA responses for the names they cover (RFC 8198).
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.next_purge = 0.0
+        self.count = 0
+        self.zones = {}
+
+    def __len__(self):
+        return self.count
+
+    def add(self, response: Message):
+        """Store the NSEC and NSEC3 records of a validated negative response.
+        :param response: DNS response of the upstream resolver.
+        """
+        if (
+            not response.flags & flags.AD
+            or response.answer
+            or response.rcode() not in (rcode.NOERROR, rcode.NXDOMAIN)
+        ):
+            return
+        soa = [r for r in response.authority if r.rdtype == rdatatype.SOA]
+        if not soa:
+            return
+        origin = soa[0].name
+        soa += [
+            r
+            for r in response.authority
+            if r.rdtype == rdatatype.RRSIG and r.covers == rdatatype.SOA
+        ]
+        # Negative TTL of RFC 2308 and RFC 9077.
+        ttl = min(soa[0].ttl, soa[0][0].minimum)
+        now = time.time()
+        with self.lock:
+            if self.count >= self.max_entries:
+                # A full purge is too slow to run on each response of a flood.
+                if now < self.next_purge:
+                    return
+                self.purge(now)
+                self.next_purge = now + PURGE_INTERVAL
+                if self.count >= self.max_entries:
+                    return
+            zone = self.zones.get(origin)
+            if zone is None:
+                zone = self.zones[origin] = Zone(soa, now + ttl)
+            else:
+                zone.soa = soa
+                zone.expires = now + ttl
+            for rrset in response.authority:
+                if rrset.rdtype == rdatatype.NSEC and rrset.name.is_subdomain(origin):
+                    self._add_nsec(zone, rrset, response, min(ttl, rrset.ttl), now)
+                elif rrset.rdtype == rdatatype.NSEC3:
+                    self._add_nsec3(zone, rrset, response, min(ttl, rrset.ttl), now)
+
+    @staticmethod
+    def _signed(rrset, response: Message) -> list:
+        rrsigs = [
+            r
+            for r in response.authority
+            if r.rdtype == rdatatype.RRSIG
+            and r.covers == rrset.rdtype
+            and r.name == rrset.name
+        ]
+        return [rrset] + rrsigs
+
+    def _add_nsec(self, zone: Zone, rrset, response: Message, ttl: int, now: float):
+        if zone.nsec3_params:
+            return
+        rdata = rrset[0]
+        if zone.add(
+            rrset.name,
+            Entry(rdata.next, get_types(rdata), self._signed(rrset, response), now + ttl),
+        ):
+            self.count += 1
+
+    def _add_nsec3(self, zone: Zone, rrset, response: Message, ttl: int, now: float):
+        if rrset.name.parent() != zone.soa[0].name:
+            return
+        rdata = rrset[0]
+        if rdata.iterations > MAX_NSEC3_ITERATIONS:
+            return
+        params = (rdata.algorithm, rdata.iterations, rdata.salt)
+        if zone.nsec3_params != params:
+            zone.nsec3_params = params
+            self.count -= len(zone.entries)
+            zone.owners = []
+            zone.entries = {}
+        owner = rrset.name[0].decode().upper()
+        next_owner = base64.b32encode(rdata.next).translate(B32_TO_B32HEX).decode()
+        entry = Entry(
+            next_owner,
+            get_types(rdata),
+            self._signed(rrset, response),
+            now + ttl,
+            opt_out=bool(rdata.flags & 0x01),
+        )
+        if zone.add(owner, entry):
+            self.count += 1
+
+    def purge(self, now: float):
+        for origin, zone in list(self.zones.items()):
+            zone.purge(now)
+            if not zone.entries or zone.expires <= now:
+                del self.zones[origin]
+        self.count = sum(len(zone.entries) for zone in self.zones.values())
+
+    def synthesize(self, query: Message) -> Optional[Message]:
+        """Build a NXDOMAIN or NODATA response from the cached records.
+        :param query: DNS query of the client.
+        :return: the response or None if the cached records do not prove it.
+        """
+        if len(query.question) != 1:
+            return None
+        question = query.question[0]
+        qname = question.name.canonicalize()
+        if question.rdtype == rdatatype.ANY:
+            return None
+        if question.rdtype == rdatatype.DS:
+            if qname == name.root:
+                return None
+            # The DS records of a zone are in its parent zone.
+            qname_zone = qname.parent()
+        else:
+            qname_zone = qname
+        now = time.time()
+        with self.lock:
+            zone = self._zone(qname_zone, now)
+            if zone is None:
+                return None
+            if zone.nsec3_params:
+                proof = self._nsec3_proof(zone, qname, question.rdtype, now)
+            else:
+                proof = self._nsec_proof(zone, qname, question.rdtype, now)
+            if proof is None:
+                return None
+            code, entries = proof
+            expires = min([zone.expires] + [e.expires for e in entries])
+            rrsets = list(zone.soa)
+            for entry in entries:
+                for rrset in entry.rrsets:
+                    if rrset not in rrsets:
+                        rrsets.append(rrset)
+        return self._response(query, code, rrsets, expires - now)
+
+    def _zone(self, qname: name.Name, now: float) -> Optional[Zone]:
+        while True:
+            zone = self.zones.get(qname)
+            if zone is not None:
+                return zone if zone.expires > now else None
+            if qname == name.root:
+                return None
+            qname = qname.parent()
+
+    @staticmethod
+    def _nodata(entry: Entry, rdtype: int) -> bool:
+        if rdtype in entry.types or rdatatype.CNAME in entry.types:
+            return False
+        # The apex NSEC of a child zone proves nothing about its DS records.
+        if rdtype == rdatatype.DS and rdatatype.SOA in entry.types:
+            return False
+        # Above a delegation, only the parent side records (DS) are known.
+        if rdatatype.NS in entry.types and rdatatype.SOA not in entry.types:
+            return rdtype == rdatatype.DS
+        return True
+
+    def _nsec_proof(self, zone: Zone, qname: name.Name, rdtype: int, now: float):
+        entry, match = zone.find(qname, now)
+        if entry is None:
+            return None
+        if match:
+            return (rcode.NOERROR, [entry]) if self._nodata(entry, rdtype) else None
+        owner = entry.rrsets[0].name
+        if qname.is_subdomain(owner) and (
+            rdatatype.DNAME in entry.types
+            or (rdatatype.NS in entry.types and rdatatype.SOA not in entry.types)
+        ):
+            # The name is redirected by a DNAME, or can exist below a delegation.
+            return None
+        if entry.next_owner.is_subdomain(qname):
+            # Empty non-terminal: the name exists, with no records.
+            return rcode.NOERROR, [entry]
+        encloser = max(
+            qname.fullcompare(owner)[2],
+            qname.fullcompare(entry.next_owner)[2],
+        )
+        closest_encloser = name.Name(qname.labels[-encloser:])
+        wildcard = name.Name((b"*",) + closest_encloser.labels)
+        wildcard_entry, match = zone.find(wildcard, now)
+        if wildcard_entry is None or match:
+            return None
+        return rcode.NXDOMAIN, [entry, wildcard_entry]
+
+    def _nsec3_proof(self, zone: Zone, qname: name.Name, rdtype: int, now: float):
+        algorithm, iterations, salt = zone.nsec3_params
+        origin = zone.soa[0].name
+
+        def nsec3_hash(n):
+            return dnssec.nsec3_hash(n, salt, iterations, algorithm)
+
+        entry, match = zone.find(nsec3_hash(qname), now)
+        if match:
+            return (rcode.NOERROR, [entry]) if self._nodata(entry, rdtype) else None
+        if qname == origin:
+            return None
+        # Closest encloser proof (RFC 5155 section 7.2.1).
+        next_closer = qname
+        closest_encloser = qname.parent()
+        while closest_encloser.is_subdomain(origin):
+            encloser_entry, match = zone.find(nsec3_hash(closest_encloser), now)
+            if match:
+                break
+            next_closer = closest_encloser
+            closest_encloser = closest_encloser.parent()
+        else:
+            return None
+        if rdatatype.DNAME in encloser_entry.types or (
+            rdatatype.NS in encloser_entry.types
+            and rdatatype.SOA not in encloser_entry.types
+        ):
+            return None
+        next_closer_entry, match = zone.find(nsec3_hash(next_closer), now)
+        if next_closer_entry is None or match or next_closer_entry.opt_out:
+            return None
+        wildcard = name.Name((b"*",) + closest_encloser.labels)
+        wildcard_entry, match = zone.find(nsec3_hash(wildcard), now)
+        if wildcard_entry is None or match:
+            return None
+        return rcode.NXDOMAIN, [encloser_entry, next_closer_entry, wildcard_entry]
+
+    @staticmethod
+    def _response(query: Message, code: int, rrsets: list, ttl: float) -> Message:
+        response = make_response(query)
+        response.set_rcode(code)
+        response.flags |= flags.RA
+        dnssec_ok = query.ednsflags & flags.DO
+        if dnssec_ok:
+            response.want_dnssec(True)
+        if dnssec_ok or query.flags & flags.AD:
+            response.flags |= flags.AD
+        for rrset in rrsets:
+            if rrset.rdtype in DNSSEC_TYPES and not dnssec_ok:
+                continue
+            rrset = rrset.copy()
+            rrset.ttl = min(rrset.ttl, int(ttl))
+            response.authority.append(rrset)
+        return response
+
+
+negative_cache = NegativeCache()
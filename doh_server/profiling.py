@@ -0,0 +1,143 @@
+import cProfile
+import functools
+import itertools
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+
+
+class ServerTiming:
+    """Duration of each stage of a request, sent in a Server-Timing header."""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.durations = []
+        self.start = self.last = time.monotonic()
+        self.nested = 0.0
+
+    def mark(self, stage: str):
+        """Record the time spent since the previous mark, minus the stages
+        measured in between.
+        :param stage: name of the stage which just ended.
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        self.durations.append((stage, now - self.last - self.nested))
+        self.last = now
+        self.nested = 0.0
+
+    def measure(self, stage: str, func, *args):
+        """Call a function and record its duration, can be run in another thread.
+        :param stage: name of the stage.
+        :param func: the function to call.
+        :return: the result of the function.
+        """
+        if not self.enabled:
+            return func(*args)
+        start = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            duration = time.monotonic() - start
+            self.durations.append((stage, duration))
+            self.nested += duration
+
+    def set_header(self, response: HttpResponse) -> HttpResponse:
+        if self.enabled:
+            durations = self.durations + [("total", time.monotonic() - self.start)]
+            response["Server-Timing"] = ", ".join(
+                "%s;dur=%.3f" % (stage, duration * 1000) for stage, duration in durations
+            )
+        return response
+
+
+class SamplingProfiler:
+    """Run cProfile on 1 request out of SAMPLE_RATE and aggregate the profiles of
+    the process in DIRECTORY/doh-server-<pid>.prof, written every DUMP_EVERY samples.
+    """
+
+    def __init__(self):
+        self.counter = itertools.count(1)
+        # Only one profiler can be enabled at a time.
+        self.lock = threading.Lock()
+        # Profiles of the threads run for the sampled request of this thread.
+        self.local = threading.local()
+        self.stats = None
+        self.samples = 0
+
+    def __call__(self, view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            conf = settings.DOH_SERVER.get("PROFILER")
+            if not conf:
+                return view(request, *args, **kwargs)
+            rate = conf.get("SAMPLE_RATE", 1000)
+            if not isinstance(rate, int) or rate < 1:
+                raise Exception("Invalid profiler sample rate : %s" % rate)
+            if next(self.counter) % rate or not self.lock.acquire(blocking=False):
+                return view(request, *args, **kwargs)
+            try:
+                profiles = self.local.profiles = []
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    return view(request, *args, **kwargs)
+                finally:
+                    profile.disable()
+                    self.local.profiles = None
+                    self.add([profile] + profiles, conf)
+            finally:
+                self.lock.release()
+
+        return wrapper
+
+    def in_thread(self, func):
+        """Profile a function submitted to another thread by the sampled request.
+        Since Python 3.12, the profile of the view already covers all the threads.
+        :param func: the function to call in the other thread.
+        :return: the function to submit.
+        """
+        profiles = getattr(self.local, "profiles", None)
+        if profiles is None or sys.version_info >= (3, 12):
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                profiles.append(profile)
+
+        return wrapper
+
+    def add(self, profiles: list, conf: dict):
+        if self.stats is None:
+            self.stats = pstats.Stats(*profiles)
+        else:
+            self.stats.add(*profiles)
+        self.samples += 1
+        if self.samples % conf.get("DUMP_EVERY", 100) == 0:
+            self.dump(conf.get("DIRECTORY", tempfile.gettempdir()))
+
+    def dump(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "doh-server-%d.prof" % os.getpid())
+        self.stats.dump_stats(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        logging.getLogger("doh-server").debug(
+            "Profile of %d requests written in %s" % (self.samples, path)
+        )
+
+
+sample_profile = SamplingProfiler()
@@ -3,6 +3,7 @@ import binascii
 import json
 import logging
 from string import Template
+from typing import Optional
 
 from django.conf import settings
 from django.http import HttpResponse, HttpRequest
@@ -59,12 +60,20 @@ def get_scheme(request: HttpRequest) -> str:
 
 def set_headers(
     request: HttpRequest, response: HttpResponse, query_response: Message
+) -> HttpResponse:
+    ttl = None
+    if query_response.answer:
+        ttl = min(r.ttl for r in query_response.answer)
+    return set_headers_with_ttl(request, response, ttl)
+
+
+def set_headers_with_ttl(
+    request: HttpRequest, response: HttpResponse, ttl: Optional[int]
 ) -> HttpResponse:
     response["authority"] = settings.DOH_SERVER["AUTHORITY"]
     response["method"] = request.method
     response["scheme"] = get_scheme(request)
-    if query_response.answer:
-        ttl = min(r.ttl for r in query_response.answer)
+    if ttl is not None:
         response["cache-control"] = "max-age=" + str(ttl)
     return response
 
@@ -114,6 +123,14 @@ def create_http_wire_response(request, query_response):
         return HttpResponse(status=200, content=query_response)
 
 
+def create_http_cached_wire_response(request, body: bytes, ttl: Optional[int]):
+    logger = logging.getLogger("doh-server")
+    logger.debug("[HTTP] " + str(request.method) + " " + str(request.content_type))
+    response = HttpResponse(content=body, content_type=DOH_CONTENT_TYPE)
+    response["content-length"] = str(len(body))
+    return set_headers_with_ttl(request, response, ttl)
+
+
 def create_http_json_response(request, query_response):
     logger = logging.getLogger("doh-server")
     logger.debug("[HTTP] " + str(request.method) + " " + str(request.content_type))
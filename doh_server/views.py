@@ -8,12 +8,17 @@ from django.views.decorators.http import require_http_methods
 from dns import rcode
 from dns.message import Message
 
+from doh_server.cache import get_cache, make_key, get_ttl, from_cache, patch_ttl
 from doh_server.constants import DOH_CONTENT_TYPE, DOH_JSON_CONTENT_TYPE
 from doh_server.dns_resolver import DNSResolverClient
+from doh_server.iterative_resolver import IterativeResolverClient
+from doh_server.negative_cache import negative_cache, with_dnssec, strip_dnssec
+from doh_server.profiling import ServerTiming, sample_profile
 from doh_server.utils import (
     configure_logger,
     get_name_and_type_from_dns_question,
     create_http_wire_response,
+    create_http_cached_wire_response,
     create_http_json_response,
 )
 
@@ -22,29 +27,74 @@ logger = configure_logger("doh-server", level=settings.DOH_SERVER["LOGGER_LEVEL"
 
 @csrf_exempt
 @require_http_methods(["GET", "POST"])
+@sample_profile
 def doh_request(request):
-    resolver_dns = DNSResolverClient(settings.DOH_SERVER["RESOLVER"])
+    timing = ServerTiming(settings.DOH_SERVER.get("SERVER_TIMING", False))
+    if settings.DOH_SERVER["RESOLVER"] == "iterative":
+        resolver_dns = IterativeResolverClient(settings.DOH_SERVER.get("ROOT_HINTS"))
+    else:
+        resolver_dns = DNSResolverClient(settings.DOH_SERVER["RESOLVER"])
     accept_header = request.headers.get("Accept")
     message = get_name_and_type_from_dns_question(request)
     if not message:
         return HttpResponseBadRequest()
-    try:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(resolver_dns.resolve, message)
-            query_response = future.result()
-        if isinstance(query_response, Message):
-            if query_response.answer:
-                logger.debug("[DNS] " + str(query_response.answer[0]))
+    timing.mark("parse")
+    cache = get_cache(settings.DOH_SERVER.get("CACHE"))
+    aggressive_nsec = settings.DOH_SERVER.get("AGGRESSIVE_NSEC", False)
+    key = make_key(message) if cache else None
+    cached = cache.get(key) if key else None
+    query_response = None
+    if cached:
+        logger.debug("[CACHE] " + str(message.question[0]))
+        try:
+            if request.method == "GET" and accept_header == DOH_JSON_CONTENT_TYPE:
+                query_response = from_cache(*cached)
             else:
-                logger.debug("[DNS] " + str(query_response.question[0]))
-        else:
-            logger.warning("[DNS] Timeout on " + resolver_dns.name_server)
-            query_response = dns.message.make_response(message)
-            query_response.set_rcode(rcode.SERVFAIL)
-    except Exception as ex:
-        logger.exception(str(ex))
-        return HttpResponseBadRequest()
+                # The cached wire format is sent as is, without being decoded.
+                response = create_http_cached_wire_response(
+                    request, *patch_ttl(*cached)
+                )
+                timing.mark("cache")
+                return timing.set_header(response)
+        except Exception as ex:
+            logger.warning("[CACHE] Invalid entry: " + str(ex))
+    if query_response is None and aggressive_nsec:
+        query_response = negative_cache.synthesize(message)
+        if query_response:
+            logger.debug("[NSEC] " + str(message.question[0]))
+    if cache or aggressive_nsec:
+        timing.mark("cache")
+    if query_response is None:
+        try:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                future = executor.submit(
+                    sample_profile.in_thread(timing.measure),
+                    "resolve",
+                    resolver_dns.resolve,
+                    with_dnssec(message) if aggressive_nsec else message,
+                )
+                query_response = future.result()
+            timing.mark("executor")
+            if isinstance(query_response, Message):
+                if aggressive_nsec:
+                    negative_cache.add(query_response)
+                    query_response = strip_dnssec(query_response, message)
+                if key:
+                    cache.set(key, query_response.to_wire(), get_ttl(query_response))
+                if query_response.answer:
+                    logger.debug("[DNS] " + str(query_response.answer[0]))
+                else:
+                    logger.debug("[DNS] " + str(query_response.question[0]))
+            else:
+                logger.warning("[DNS] Timeout on " + resolver_dns.name_server)
+                query_response = dns.message.make_response(message)
+                query_response.set_rcode(rcode.SERVFAIL)
+        except Exception as ex:
+            logger.exception(str(ex))
+            return HttpResponseBadRequest()
     if request.method == "GET" and accept_header == DOH_JSON_CONTENT_TYPE:
-        return create_http_json_response(request, query_response)
+        response = create_http_json_response(request, query_response)
     else:
-        return create_http_wire_response(request, query_response)
+        response = create_http_wire_response(request, query_response)
+    timing.mark("serialize")
+    return timing.set_header(response)
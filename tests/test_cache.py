@@ -0,0 +1,171 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+
+import dns
+from dns import rcode
+
+from doh_server.cache import (
+    SEQUENCE,
+    SharedMemoryCache,
+    make_key,
+    get_ttl,
+    from_cache,
+    patch_ttl,
+)
+
+
+def _store(path, key, value):
+    cache = SharedMemoryCache(path, slots=16, value_size=64)
+    cache.set(key, value, 60)
+    cache.close()
+
+
+class TestSharedMemoryCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache")
+        self.cache = SharedMemoryCache(self.path, slots=16, value_size=64)
+        self.query = dns.message.make_query(
+            qname="example.com", rdtype="A", want_dnssec=False
+        )
+        self.response = dns.message.make_response(self.query)
+        self.response.answer.append(
+            dns.rrset.from_text("example.com.", 300, "IN", "A", "93.184.216.34")
+        )
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_make_key(self):
+        upper = dns.message.make_query(qname="EXAMPLE.com", rdtype="A")
+        assert make_key(self.query) == make_key(upper)
+        aaaa = dns.message.make_query(qname="example.com", rdtype="AAAA")
+        assert make_key(self.query) != make_key(aaaa)
+        dnssec = dns.message.make_query(
+            qname="example.com", rdtype="A", want_dnssec=True
+        )
+        assert make_key(self.query) != make_key(dnssec)
+        checking_disabled = dns.message.make_query(
+            qname="example.com", rdtype="A", want_dnssec=False
+        )
+        checking_disabled.flags |= dns.flags.CD
+        assert make_key(self.query) != make_key(checking_disabled)
+        edns = dns.message.make_query(qname="example.com", rdtype="A", use_edns=0)
+        assert make_key(self.query) != make_key(edns)
+
+    def test_get_ttl(self):
+        assert get_ttl(self.response) == 300
+        assert get_ttl(dns.message.make_response(self.query)) == 0
+        self.response.set_rcode(rcode.SERVFAIL)
+        assert get_ttl(self.response) == 0
+        negative = dns.message.make_response(self.query)
+        negative.set_rcode(rcode.NXDOMAIN)
+        negative.authority.append(
+            dns.rrset.from_text(
+                "com.", 3600, "IN", "SOA", "ns.com. hostmaster.com. 1 3600 600 86400 300"
+            )
+        )
+        assert get_ttl(negative) == 300
+        negative.set_rcode(rcode.NOERROR)
+        assert get_ttl(negative) == 300
+
+    def test_set_get(self):
+        key = make_key(self.query)
+        assert self.cache.get(key) is None
+        assert self.cache.set(key, b"response", 60)
+        value, expires = self.cache.get(key)
+        assert value == b"response"
+        assert expires > time.time()
+        assert self.cache.set(key, b"updated", 60)
+        assert self.cache.get(key)[0] == b"updated"
+
+    def test_not_stored(self):
+        key = make_key(self.query)
+        assert not self.cache.set(key, b"response", 0)
+        assert not self.cache.set(key, b"x" * 65, 60)
+        assert self.cache.get(key) is None
+
+    def test_expired(self):
+        key = make_key(self.query)
+        self.cache.set(key, b"response", 60)
+        self.cache.set(key, b"response", -1)
+        assert self.cache.get(key)[0] == b"response"
+        self.cache._write(
+            self.cache._hash(key) % self.cache.slots,
+            self.cache._hash(key),
+            time.time() - 1,
+            key,
+            b"response",
+        )
+        assert self.cache.get(key) is None
+
+    def test_write_in_progress(self):
+        key = make_key(self.query)
+        self.cache.set(key, b"response", 60)
+        offset = self.cache._offset(self.cache._hash(key) % self.cache.slots)
+        seq = SEQUENCE.unpack_from(self.cache.mm, offset)[0]
+        assert seq == 2
+        SEQUENCE.pack_into(self.cache.mm, offset, seq + 1)
+        assert self.cache.get(key) is None
+        SEQUENCE.pack_into(self.cache.mm, offset, seq)
+        assert self.cache.get(key)[0] == b"response"
+
+    def test_interrupted_write(self):
+        key = make_key(self.query)
+        self.cache.set(key, b"response", 60)
+        offset = self.cache._offset(self.cache._hash(key) % self.cache.slots)
+        SEQUENCE.pack_into(self.cache.mm, offset, 3)
+        self.cache.set(key, b"updated", 60)
+        assert SEQUENCE.unpack_from(self.cache.mm, offset)[0] == 4
+        assert self.cache.get(key)[0] == b"updated"
+
+    def test_collisions(self):
+        keys = [("key%d" % i).encode() for i in range(32)]
+        for key in keys:
+            self.cache.set(key, key, 60)
+        found = [key for key in keys if self.cache.get(key)]
+        assert 0 < len(found) <= 16
+        for key in found:
+            assert self.cache.get(key)[0] == key
+
+    def test_shared_between_processes(self):
+        key = make_key(self.query)
+        process = multiprocessing.get_context("fork").Process(
+            target=_store, args=(self.path, key, b"from child")
+        )
+        process.start()
+        process.join()
+        assert self.cache.get(key)[0] == b"from child"
+
+    def test_other_layout(self):
+        with self.assertRaises(Exception):
+            SharedMemoryCache(self.path, slots=32, value_size=64)
+
+    def test_from_cache(self):
+        response = from_cache(self.response.to_wire(), time.time() + 10.5)
+        assert str(response.answer[0]) == "example.com. 10 IN A 93.184.216.34"
+
+    def test_patch_ttl(self):
+        self.response.use_edns(0, dns.flags.DO)
+        self.response.authority.append(
+            dns.rrset.from_text("example.com.", 5, "IN", "NS", "ns.example.com.")
+        )
+        wire, ttl = patch_ttl(self.response.to_wire(), time.time() + 10.5)
+        assert ttl == 10
+        response = dns.message.from_wire(wire)
+        assert response.id == 0
+        assert response.answer[0].ttl == 10
+        assert response.authority[0].ttl == 5
+        assert response.ednsflags & dns.flags.DO
+        wire, ttl = patch_ttl(self.response.to_wire(), time.time() - 1)
+        assert ttl == 0
+        with self.assertRaises(Exception):
+            patch_ttl(self.response.to_wire()[:-4], time.time() + 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,237 @@
+import socket
+import socketserver
+import threading
+import unittest
+
+import dns
+import dns.zone
+from dns import flags, rcode, rdatatype
+from dns.message import Message
+
+from doh_server.iterative_resolver import InfrastructureCache, IterativeResolverClient
+
+ZONES = {
+    "127.0.0.10": (
+        ".",
+        """
+@ 300 IN SOA a.root. hostmaster.root. 1 3600 600 86400 300
+@ 300 IN NS a.root.
+a.root. 300 IN A 127.0.0.10
+test. 300 IN NS ns1.test.
+ns1.test. 300 IN A 127.0.0.11
+example. 300 IN NS ns.hosting.test.
+evil. 300 IN NS ns.evil.
+ns.evil. 300 IN A 127.0.0.14
+""",
+    ),
+    "127.0.0.11": (
+        "test.",
+        """
+@ 300 IN SOA ns1 hostmaster 1 3600 600 86400 300
+@ 300 IN NS ns1
+ns1 300 IN A 127.0.0.11
+www 300 IN A 192.0.2.1
+alias 300 IN CNAME www.example.
+ns.hosting 300 IN A 127.0.0.12
+""",
+    ),
+    "127.0.0.12": (
+        "example.",
+        """
+@ 300 IN SOA ns.hosting.test. hostmaster 1 3600 600 86400 300
+@ 300 IN NS ns.hosting.test.
+www 300 IN A 192.0.2.2
+""",
+    ),
+    "127.0.0.14": (
+        "evil.",
+        """
+@ 300 IN SOA ns hostmaster 1 3600 600 86400 300
+@ 300 IN NS ns
+ns 300 IN A 127.0.0.14
+alias 300 IN CNAME www.test.
+""",
+    ),
+}
+# Out of zone records sent by a server along with its answers.
+INJECTED = {"127.0.0.14": ("www.test.", 300, "IN", "A", "6.6.6.6")}
+
+
+def authoritative_response(zone, query: Message) -> Message:
+    """Minimal authoritative server: referral, answer, NODATA or NXDOMAIN."""
+    response = dns.message.make_response(query)
+    question = query.question[0]
+    qname = question.name
+    soa = zone.get_rrset(zone.origin, rdatatype.SOA)
+    cut = qname
+    while cut != zone.origin:
+        ns = zone.get_rrset(cut, rdatatype.NS)
+        # The DS records of a child zone are answered by its parent.
+        if ns and not (cut == qname and question.rdtype == rdatatype.DS):
+            response.authority.append(ns)
+            for rdata in ns:
+                glue = zone.get_rrset(rdata.target, rdatatype.A)
+                if glue:
+                    response.additional.append(glue)
+            return response
+        cut = cut.parent()
+    response.flags |= flags.AA
+    node = zone.get_node(qname)
+    if node is None:
+        response.set_rcode(rcode.NXDOMAIN)
+        response.authority.append(soa)
+        return response
+    rrset = zone.get_rrset(qname, question.rdtype) or zone.get_rrset(
+        qname, rdatatype.CNAME
+    )
+    if rrset:
+        response.answer.append(rrset)
+    else:
+        response.authority.append(soa)
+    return response
+
+
+class StubServer(socketserver.ThreadingUDPServer):
+    def __init__(self, address, zone):
+        self.zone = zone
+        self.injected = INJECTED.get(address[0])
+        self.queries = []
+        self.last_query = None
+        super().__init__(address, StubHandler)
+
+
+class StubHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        query = dns.message.from_wire(data)
+        self.server.queries.append(str(query.question[0].name))
+        self.server.last_query = query
+        response = authoritative_response(self.server.zone, query)
+        if response.answer and self.server.injected:
+            response.answer.append(
+                dns.rrset.from_text(*self.server.injected)
+            )
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+class TestIterativeResolver(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(("127.0.0.10", 0))
+            cls.port = sock.getsockname()[1]
+        cls.servers = {}
+        for address, (origin, text) in ZONES.items():
+            zone = dns.zone.from_text(text, origin=origin, relativize=False)
+            server = StubServer((address, cls.port), zone)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            cls.servers[address] = server
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def setUp(self):
+        self.cache = InfrastructureCache()
+        self.resolver = IterativeResolverClient(
+            ["127.0.0.10"], port=self.port, cache=self.cache
+        )
+        for server in self.servers.values():
+            server.queries.clear()
+
+    def test_answer(self):
+        query = dns.message.make_query("www.test.", "A")
+        result = self.resolver.resolve(query)
+        assert isinstance(result, Message)
+        assert result.rcode() == 0
+        assert result.flags & flags.RA
+        assert "192.0.2.1" in str(result.answer[0])
+
+    def test_nxdomain(self):
+        result = self.resolver.resolve(dns.message.make_query("nothing.test.", "A"))
+        assert result.rcode() == 3
+        assert not result.answer
+        assert result.authority[0].rdtype == rdatatype.SOA
+
+    def test_nodata(self):
+        result = self.resolver.resolve(dns.message.make_query("www.test.", "AAAA"))
+        assert result.rcode() == 0
+        assert not result.answer
+
+    def test_delegation_without_glue(self):
+        result = self.resolver.resolve(dns.message.make_query("www.example.", "A"))
+        assert "192.0.2.2" in str(result.answer[0])
+        assert self.cache.get_addresses(dns.name.from_text("ns.hosting.test.")) == [
+            "127.0.0.12"
+        ]
+
+    def test_cname(self):
+        result = self.resolver.resolve(dns.message.make_query("alias.test.", "A"))
+        assert result.rcode() == 0
+        assert result.answer[0].rdtype == rdatatype.CNAME
+        assert "192.0.2.2" in str(result.answer[1])
+
+    def test_infrastructure_reused(self):
+        self.resolver.resolve(dns.message.make_query("www.test.", "A"))
+        assert self.servers["127.0.0.10"].queries == ["www.test."]
+        other = IterativeResolverClient(["127.0.0.10"], port=self.port, cache=self.cache)
+        other.resolve(dns.message.make_query("nothing.test.", "A"))
+        assert self.servers["127.0.0.10"].queries == ["www.test."]
+        assert self.servers["127.0.0.11"].queries == ["www.test.", "nothing.test."]
+        assert "127.0.0.11" in self.cache.rtt
+
+    def test_out_of_bailiwick(self):
+        result = self.resolver.resolve(dns.message.make_query("alias.evil.", "A"))
+        assert "6.6.6.6" not in str(result.answer)
+        assert result.answer[0].rdtype == rdatatype.CNAME
+        assert "192.0.2.1" in str(result.answer[1])
+        assert "www.test." in self.servers["127.0.0.11"].queries
+
+    def test_ds(self):
+        self.resolver.resolve(dns.message.make_query("www.example.", "A"))
+        self.servers["127.0.0.12"].queries.clear()
+        result = self.resolver.resolve(dns.message.make_query("example.", "DS"))
+        assert result.rcode() == 0
+        assert not result.answer
+        assert result.authority[0].name == dns.name.root
+        assert "example." in self.servers["127.0.0.10"].queries
+        assert self.servers["127.0.0.12"].queries == []
+
+    def test_dnssec_ok(self):
+        query = dns.message.make_query("www.test.", "A", want_dnssec=True)
+        result = self.resolver.resolve(query)
+        assert result.ednsflags & flags.DO
+        assert self.servers["127.0.0.11"].last_query.ednsflags & flags.DO
+        self.resolver.resolve(dns.message.make_query("www.test.", "AAAA"))
+        assert self.servers["127.0.0.11"].last_query.edns < 0
+
+    def test_not_authoritative(self):
+        response = dns.message.make_response(dns.message.make_query("www.test.", "A"))
+        response.answer.append(
+            dns.rrset.from_text("www.test.", 300, "IN", "A", "192.0.2.1")
+        )
+        assert IterativeResolverClient._in_bailiwick(response, dns.name.root) is None
+
+    def test_cache_limit(self):
+        cache = InfrastructureCache(max_entries=2)
+        names = [dns.name.from_text("ns%d.test." % i) for i in range(3)]
+        cache.add_addresses(names[0], ["192.0.2.1"], -1)
+        cache.add_addresses(names[1], ["192.0.2.2"], 300)
+        cache.add_addresses(names[2], ["192.0.2.3"], 300)
+        assert names[0] not in cache.addresses
+        assert cache.get_addresses(names[2]) == ["192.0.2.3"]
+        cache.add_addresses(names[0], ["192.0.2.1"], 300)
+        assert len(cache.addresses) == 2
+        for address in ("192.0.2.2", "192.0.2.3", "192.0.2.4"):
+            cache.update_rtt(address, 0.1)
+        assert len(cache.rtt) == 2
+
+    def test_unreachable(self):
+        resolver = IterativeResolverClient(["127.0.0.13"], port=self.port, cache=self.cache)
+        assert resolver.resolve(dns.message.make_query("www.test.", "A")) == 0
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,357 @@
+import unittest
+
+import dns
+import dns.dnssec
+from django.test import TestCase, Client
+from django.urls import reverse
+from dns import flags, rcode, rdatatype
+
+from doh_server.constants import DOH_CONTENT_TYPE
+from doh_server.negative_cache import (
+    NegativeCache,
+    covers,
+    negative_cache,
+    with_dnssec,
+    strip_dnssec,
+)
+
+SOA = "ns.{0} hostmaster.{0} 1 3600 600 86400 300"
+RRSIG = "{0} 8 2 300 20300101000000 20200101000000 12345 {1} AAAA"
+
+
+def negative_response(qname, rdtype, code, origin, records):
+    """Validated negative response with the given NSEC or NSEC3 records."""
+    query = dns.message.make_query(qname, rdtype, want_dnssec=True)
+    response = dns.message.make_response(query)
+    response.flags |= flags.AD
+    response.set_rcode(code)
+    response.authority.append(
+        dns.rrset.from_text(origin, 3600, "IN", "SOA", SOA.format(origin))
+    )
+    response.authority.append(
+        dns.rrset.from_text(origin, 3600, "IN", "RRSIG", RRSIG.format("SOA", origin))
+    )
+    for owner, rdtype_text, text in records:
+        response.authority.append(
+            dns.rrset.from_text(owner, 3600, "IN", rdtype_text, text)
+        )
+        response.authority.append(
+            dns.rrset.from_text(
+                owner, 3600, "IN", "RRSIG", RRSIG.format(rdtype_text, origin)
+            )
+        )
+    return response
+
+
+NSEC_RECORDS = [
+    ("example.", "NSEC", "a.example. NS SOA RRSIG NSEC DNSKEY"),
+    ("a.example.", "NSEC", "d.example. A RRSIG NSEC"),
+    ("d.example.", "NSEC", "m.example. NS RRSIG NSEC"),
+    ("m.example.", "NSEC", "example. A RRSIG NSEC"),
+]
+
+
+class TestNegativeCacheNSEC(unittest.TestCase):
+    def setUp(self):
+        self.cache = NegativeCache()
+        self.cache.add(
+            negative_response(
+                "b.example.", "A", rcode.NXDOMAIN, "example.", NSEC_RECORDS[:2]
+            )
+        )
+        self.cache.add(
+            negative_response(
+                "m.example.", "AAAA", rcode.NOERROR, "example.", NSEC_RECORDS[2:]
+            )
+        )
+
+    def synthesize(self, qname, rdtype, want_dnssec=False):
+        query = dns.message.make_query(qname, rdtype, want_dnssec=want_dnssec)
+        return self.cache.synthesize(query)
+
+    def test_nxdomain(self):
+        response = self.synthesize("c.example.", "A")
+        assert response.rcode() == rcode.NXDOMAIN
+        assert [r.rdtype for r in response.authority] == [rdatatype.SOA]
+        assert response.authority[0].ttl <= 300
+        assert self.synthesize("zzz.example.", "A").rcode() == rcode.NXDOMAIN
+        assert self.synthesize("x.a.example.", "A").rcode() == rcode.NXDOMAIN
+
+    def test_nxdomain_dnssec(self):
+        response = self.synthesize("C.example.", "A", want_dnssec=True)
+        assert response.rcode() == rcode.NXDOMAIN
+        assert response.flags & flags.AD
+        assert response.ednsflags & flags.DO
+        types = [r.rdtype for r in response.authority]
+        assert types.count(rdatatype.NSEC) == 2
+        assert types.count(rdatatype.RRSIG) == 3
+
+    def test_nodata(self):
+        response = self.synthesize("a.example.", "AAAA")
+        assert response.rcode() == rcode.NOERROR
+        assert not response.answer
+        assert self.synthesize("a.example.", "A") is None
+        assert self.synthesize("d.example.", "DS").rcode() == rcode.NOERROR
+
+    def test_ds_at_zone_apex(self):
+        child = negative_response(
+            "b.d.example.",
+            "A",
+            rcode.NXDOMAIN,
+            "d.example.",
+            [("d.example.", "NSEC", "x.d.example. NS SOA RRSIG NSEC DNSKEY")],
+        )
+        self.cache.add(child)
+        response = self.synthesize("d.example.", "DS")
+        assert response.rcode() == rcode.NOERROR
+        assert response.authority[0].name == dns.name.from_text("example.")
+        cache = NegativeCache()
+        cache.add(child)
+        assert cache.synthesize(dns.message.make_query("d.example.", "DS")) is None
+        assert self.synthesize("example.", "DS") is None
+
+    def test_delegation(self):
+        assert self.synthesize("d.example.", "A") is None
+        assert self.synthesize("www.d.example.", "A") is None
+
+    def test_empty_non_terminal(self):
+        cache = NegativeCache()
+        cache.add(
+            negative_response(
+                "b.example.",
+                "A",
+                rcode.NXDOMAIN,
+                "example.",
+                [("a.example.", "NSEC", "b.c.example. A RRSIG NSEC")],
+            )
+        )
+        query = dns.message.make_query("c.example.", "A")
+        response = cache.synthesize(query)
+        assert response.rcode() == rcode.NOERROR
+        assert not response.answer
+
+    def test_dname(self):
+        cache = NegativeCache()
+        cache.add(
+            negative_response(
+                "b.example.",
+                "A",
+                rcode.NXDOMAIN,
+                "example.",
+                [
+                    ("example.", "NSEC", "a.example. NS SOA RRSIG NSEC DNSKEY"),
+                    ("a.example.", "NSEC", "d.example. DNAME RRSIG NSEC"),
+                ],
+            )
+        )
+        assert cache.synthesize(dns.message.make_query("x.a.example.", "A")) is None
+        response = cache.synthesize(dns.message.make_query("b.example.", "A"))
+        assert response.rcode() == rcode.NXDOMAIN
+
+    def test_not_covered(self):
+        assert self.synthesize("example.org.", "A") is None
+        assert self.synthesize("example.", "SOA") is None
+
+    def test_not_validated(self):
+        cache = NegativeCache()
+        response = negative_response(
+            "b.example.", "A", rcode.NXDOMAIN, "example.", NSEC_RECORDS
+        )
+        response.flags &= ~flags.AD
+        cache.add(response)
+        assert len(cache) == 0
+
+    def test_expired(self):
+        for zone in self.cache.zones.values():
+            for entry in zone.entries.values():
+                entry.expires = 0
+        assert self.synthesize("c.example.", "A") is None
+        self.cache.purge(1)
+        assert len(self.cache) == 0
+
+    def test_max_entries(self):
+        cache = NegativeCache(max_entries=2)
+        cache.add(
+            negative_response(
+                "b.example.", "A", rcode.NXDOMAIN, "example.", NSEC_RECORDS[:2]
+            )
+        )
+        cache.add(
+            negative_response(
+                "m.example.", "AAAA", rcode.NOERROR, "example.", NSEC_RECORDS[2:]
+            )
+        )
+        assert len(cache) == 2
+        # No purge before PURGE_INTERVAL, even once the entries expired.
+        for entry in cache.zones[dns.name.from_text("example.")].entries.values():
+            entry.expires = 0
+        cache.add(
+            negative_response(
+                "m.example.", "AAAA", rcode.NOERROR, "example.", NSEC_RECORDS[2:]
+            )
+        )
+        assert len(cache) == 2
+        cache.next_purge = 0
+        cache.add(
+            negative_response(
+                "m.example.", "AAAA", rcode.NOERROR, "example.", NSEC_RECORDS[2:]
+            )
+        )
+        assert len(cache) == 2
+        assert sorted(cache.zones[dns.name.from_text("example.")].owners) == [
+            dns.name.from_text("d.example."),
+            dns.name.from_text("m.example."),
+        ]
+
+
+class TestNegativeCacheNSEC3(unittest.TestCase):
+    def setUp(self):
+        self.cache = NegativeCache()
+        self.salt = "aabbccdd"
+        names = {
+            "example.": "NS SOA RRSIG DNSKEY NSEC3PARAM",
+            "a.example.": "A RRSIG",
+            "m.example.": "A RRSIG",
+        }
+        hashes = sorted((self.hash(n), types) for n, types in names.items())
+        self.records = []
+        self.ranges = []
+        for i, (h, types) in enumerate(hashes):
+            next_hash = hashes[(i + 1) % len(hashes)][0]
+            self.ranges.append((h, next_hash))
+            self.records.append(
+                (
+                    h + ".example.",
+                    "NSEC3",
+                    "1 0 1 %s %s %s" % (self.salt, next_hash, types),
+                )
+            )
+
+    def hash(self, qname):
+        return dns.dnssec.nsec3_hash(qname, self.salt, 1, 1)
+
+    def add(self, records):
+        self.cache.add(
+            negative_response("b.example.", "A", rcode.NXDOMAIN, "example.", records)
+        )
+
+    def synthesize(self, qname, rdtype):
+        return self.cache.synthesize(dns.message.make_query(qname, rdtype))
+
+    def test_nxdomain(self):
+        self.add(self.records)
+        for qname in ("b.example.", "random1.example.", "x.y.example."):
+            response = self.synthesize(qname, "A")
+            assert response.rcode() == rcode.NXDOMAIN
+        assert self.synthesize("x.a.example.", "A").rcode() == rcode.NXDOMAIN
+
+    def test_nodata(self):
+        self.add(self.records)
+        assert self.synthesize("a.example.", "AAAA").rcode() == rcode.NOERROR
+        assert self.synthesize("a.example.", "A") is None
+
+    def test_count(self):
+        self.add(self.records)
+        self.add(self.records)
+        assert len(self.cache) == 3
+        self.add(
+            [
+                (owner, rdtype, text.replace("1 0 1 %s" % self.salt, "1 0 1 -"))
+                for owner, rdtype, text in self.records[:1]
+            ]
+        )
+        assert len(self.cache) == 1
+
+    def test_opt_out(self):
+        records = [
+            (owner, rdtype, text.replace("1 0 1", "1 1 1"))
+            for owner, rdtype, text in self.records
+        ]
+        self.add(records)
+        assert self.synthesize("b.example.", "A") is None
+
+    def test_missing_wildcard_proof(self):
+        wildcard = self.hash("*.example.")
+        records = [
+            record
+            for record, (h, next_hash) in zip(self.records, self.ranges)
+            if not covers(h, next_hash, wildcard)
+        ]
+        self.add(records)
+        assert len(self.cache) == 2
+        assert self.synthesize("b.example.", "A") is None
+
+
+class TestDNSSECQuery(unittest.TestCase):
+    def test_with_dnssec(self):
+        query = dns.message.make_query("example.com.", "A")
+        upstream = with_dnssec(query)
+        assert upstream.ednsflags & flags.DO
+        assert upstream.flags & flags.AD
+        assert upstream.id == query.id
+        assert query.edns < 0
+
+    def test_strip_dnssec(self):
+        query = dns.message.make_query("b.example.", "A")
+        response = negative_response(
+            "b.example.", "A", rcode.NXDOMAIN, "example.", NSEC_RECORDS[:2]
+        )
+        response = strip_dnssec(response, query)
+        assert [r.rdtype for r in response.authority] == [rdatatype.SOA]
+        assert not response.flags & flags.AD
+        assert response.edns < 0
+        query = dns.message.make_query("b.example.", "A", want_dnssec=True)
+        response = negative_response(
+            "b.example.", "A", rcode.NXDOMAIN, "example.", NSEC_RECORDS[:2]
+        )
+        assert len(strip_dnssec(response, query).authority) == 6
+
+    def test_strip_dnssec_qtype(self):
+        query = dns.message.make_query("example.", "NSEC")
+        response = dns.message.make_response(with_dnssec(query))
+        owner, rdtype_text, text = NSEC_RECORDS[0]
+        response.answer.append(dns.rrset.from_text(owner, 300, "IN", rdtype_text, text))
+        response.answer.append(
+            dns.rrset.from_text(
+                owner, 300, "IN", "RRSIG", RRSIG.format(rdtype_text, owner)
+            )
+        )
+        response = strip_dnssec(response, query)
+        assert [r.rdtype for r in response.answer] == [rdatatype.NSEC]
+
+
+class AggressiveNSECTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        records = [
+            ("nsec.test.", "NSEC", "a.nsec.test. NS SOA RRSIG NSEC DNSKEY"),
+            ("a.nsec.test.", "NSEC", "nsec.test. A RRSIG NSEC"),
+        ]
+        negative_cache.add(
+            negative_response("b.nsec.test.", "A", rcode.NXDOMAIN, "nsec.test.", records)
+        )
+
+    def tearDown(self):
+        with negative_cache.lock:
+            negative_cache.zones = {}
+            negative_cache.count = 0
+
+    def test_synthesized(self):
+        with self.settings(
+            DOH_SERVER={"RESOLVER": "10.13.23.45", "AUTHORITY": "", "AGGRESSIVE_NSEC": True}
+        ):
+            message = dns.message.make_query(qname="random.nsec.test", rdtype="A")
+            response = self.client.post(
+                reverse("doh_request"),
+                HTTP_ACCEPT=DOH_CONTENT_TYPE,
+                content_type=DOH_CONTENT_TYPE,
+                data=message.to_wire(),
+            )
+            self.assertEqual(response.status_code, 200)
+            message_content = dns.message.from_wire(response.content)
+            self.assertEqual(message_content.rcode(), rcode.NXDOMAIN)
+            self.assertEqual(message_content.authority[0].rdtype, rdatatype.SOA)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import concurrent.futures
+import os
+import pstats
+import tempfile
+import unittest
+
+from django.http import HttpResponse
+from django.test import TestCase
+
+from doh_server.profiling import ServerTiming, SamplingProfiler
+
+
+class TestServerTiming(unittest.TestCase):
+    def test_stages(self):
+        timing = ServerTiming()
+        timing.mark("parse")
+        assert timing.measure("resolve", lambda x: x + 1, 1) == 2
+        timing.mark("executor")
+        response = timing.set_header(HttpResponse())
+        stages = [s.split(";")[0] for s in response["Server-Timing"].split(", ")]
+        assert stages == ["parse", "resolve", "executor", "total"]
+        assert all(d >= 0 for _, d in timing.durations)
+
+    def test_disabled(self):
+        timing = ServerTiming(False)
+        timing.mark("parse")
+        assert timing.measure("resolve", lambda: 1) == 1
+        assert not timing.durations
+        with self.assertRaises(KeyError):
+            timing.set_header(HttpResponse())["Server-Timing"]
+
+
+class SamplingProfilerTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sampling(self):
+        calls = []
+        profiler = SamplingProfiler()
+        view = profiler(lambda request: calls.append(request) or HttpResponse())
+        conf = {"SAMPLE_RATE": 2, "DUMP_EVERY": 2, "DIRECTORY": self.directory.name}
+        with self.settings(DOH_SERVER={"PROFILER": conf}):
+            for i in range(4):
+                view(i)
+        assert calls == [0, 1, 2, 3]
+        assert profiler.samples == 2
+        path = os.path.join(self.directory.name, "doh-server-%d.prof" % os.getpid())
+        assert pstats.Stats(path).total_calls > 0
+
+    def test_thread(self):
+        def resolve_in_thread():
+            return HttpResponse()
+
+        def view(request):
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                return executor.submit(profiler.in_thread(resolve_in_thread)).result()
+
+        profiler = SamplingProfiler()
+        conf = {"SAMPLE_RATE": 1, "DIRECTORY": self.directory.name}
+        with self.settings(DOH_SERVER={"PROFILER": conf}):
+            profiler(view)(None)
+        assert profiler.samples == 1
+        assert any(f[2] == "resolve_in_thread" for f in profiler.stats.stats)
+        assert profiler.in_thread(resolve_in_thread) is resolve_in_thread
+
+    def test_invalid_sample_rate(self):
+        profiler = SamplingProfiler()
+        view = profiler(lambda request: HttpResponse())
+        with self.settings(DOH_SERVER={"PROFILER": {"SAMPLE_RATE": 0}}):
+            with self.assertRaisesRegex(Exception, "sample rate"):
+                view(None)
+
+    def test_disabled(self):
+        profiler = SamplingProfiler()
+        view = profiler(lambda request: HttpResponse())
+        with self.settings(DOH_SERVER={}):
+            view(None)
+        assert profiler.samples == 0
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,11 @@
+import os
+import tempfile
+
 import dns
 from django.test import TestCase, Client
 from django.urls import reverse
 from dns import message
+from doh_server.cache import get_cache, make_key
 from doh_server.constants import DOH_CONTENT_TYPE, DOH_JSON_CONTENT_TYPE
 from doh_server.utils import doh_b64_encode
 
@@ -159,3 +163,70 @@ class GetTestCaseDNSJson(TestCase):
                     )
                     self.assertEqual(response.status_code, 200)
                     self.assertEqual("{}", response.content.decode("UTF-8"))
+
+
+class CacheTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.directory = tempfile.TemporaryDirectory()
+        self.conf = {"PATH": os.path.join(self.directory.name, "cache"), "SLOTS": 16}
+        self.query = dns.message.make_query(qname="cached.test", rdtype="A")
+        response = dns.message.make_response(self.query)
+        response.answer.append(
+            dns.rrset.from_text("cached.test.", 300, "IN", "A", "192.0.2.1")
+        )
+        get_cache(self.conf).set(make_key(self.query), response.to_wire(), 300)
+
+    def tearDown(self):
+        get_cache(self.conf).close()
+        self.directory.cleanup()
+
+    def test_cache_hit(self):
+        with self.settings(
+            DOH_SERVER={"RESOLVER": "10.13.23.45", "AUTHORITY": "", "CACHE": self.conf}
+        ):
+            response = self.client.post(
+                reverse("doh_request"),
+                HTTP_ACCEPT=DOH_CONTENT_TYPE,
+                content_type=DOH_CONTENT_TYPE,
+                data=self.query.to_wire(),
+            )
+            self.assertEqual(response.status_code, 200)
+            message_content = dns.message.from_wire(response.content)
+            self.assertEqual(message_content.rcode(), 0)
+            self.assertIn("192.0.2.1", str(message_content.answer[0]))
+            with self.assertRaises(KeyError):
+                response["Server-Timing"]
+
+    def test_cache_invalid_entry(self):
+        get_cache(self.conf).set(make_key(self.query), b"\x00\x01", 300)
+        with self.settings(
+            DOH_SERVER={"RESOLVER": "10.13.23.45", "AUTHORITY": "", "CACHE": self.conf}
+        ):
+            response = self.client.post(
+                reverse("doh_request"),
+                HTTP_ACCEPT=DOH_CONTENT_TYPE,
+                content_type=DOH_CONTENT_TYPE,
+                data=self.query.to_wire(),
+            )
+            self.assertEqual(response.status_code, 200)
+            message_content = dns.message.from_wire(response.content)
+            self.assertNotIn("192.0.2.1", str(message_content.answer))
+
+    def test_server_timing(self):
+        with self.settings(
+            DOH_SERVER={
+                "RESOLVER": "10.13.23.45",
+                "AUTHORITY": "",
+                "CACHE": self.conf,
+                "SERVER_TIMING": True,
+            }
+        ):
+            response = self.client.get(
+                reverse("doh_request"),
+                {"dns": doh_b64_encode(self.query.to_wire())},
+                HTTP_ACCEPT=DOH_CONTENT_TYPE,
+            )
+            self.assertEqual(response.status_code, 200)
+            stages = [s.split(";")[0] for s in response["Server-Timing"].split(", ")]
+            self.assertEqual(stages, ["parse", "cache", "total"])